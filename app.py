@@ -18,16 +18,28 @@
 """A build watch - watch for builds and submit images to Thoth for analysis."""
 
 import os
+import functools
 import sys
+import hashlib
+import json
+import signal
 import logging
 import time
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Iterator
+from typing import List
 from typing import Optional
-from multiprocessing import Process
-from multiprocessing import Queue
-from multiprocessing import Manager
+from typing import Tuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from queue import Queue
+from threading import Thread
 from requests.exceptions import HTTPError
+from kubernetes.client.rest import ApiException
 
 import click
 
@@ -38,10 +50,14 @@ from thoth.common import init_logging
 from thoth.common import OpenShift
 from thoth.common import __version__ as __common_version__
 from thoth.analyzer import __version__ as __analyzer_version__
-from thoth.analyzer import run_command
-from thoth.analyzer import CommandError
 from prometheus_client import CollectorRegistry, Counter, push_to_gateway
 
+from skopeo import push_image
+from workqueue import ABANDON
+from workqueue import SHUTDOWN
+from workqueue import WorkQueue
+from workqueue import stop_workers
+
 init_logging()
 prometheus_registry = CollectorRegistry()
 
@@ -52,9 +68,14 @@ __component_version__ = (
 
 _LOGGER = logging.getLogger("thoth.build_watcher")
 
-_HERE_DIR = os.path.dirname(os.path.abspath(__file__))
-_SKOPEO_EXEC_PATH = os.getenv("SKOPEO_EXEC_PATH", os.path.join(_HERE_DIR, "bin", "skopeo"))
 _THOTH_METRICS_PUSHGATEWAY_URL = os.getenv("PROMETHEUS_PUSHGATEWAY_HOST")
+# Builds and image digests are not queued again until they are not seen for this time period (in seconds).
+_QUEUED_IMAGES_TTL = int(os.getenv("THOTH_BUILD_WATCHER_DEDUPLICATION_TTL", 3600))
+# Maximum number of existing images queued as a single item in the work queue.
+_EXISTING_IMAGES_BATCH_SIZE = 16
+# Builds are selectable by their phase using "status" field, see "oc get builds --field-selector".
+_BUILD_WATCH_FIELD_SELECTOR = "status=Complete"
+_BUILD_WATCH_TIMEOUT = 600
 
 _METRIC_IMAGES_SUBMITTED = Counter(
     "build_watcher_image_submission_total", "Number of images submitted for analysis.", [], registry=prometheus_registry
@@ -71,9 +92,6 @@ _METRIC_BUILD_LOGS_SUBMITTED = Counter(
     [],
     registry=prometheus_registry,
 )
-_METRIC_BUILDS_FAILED = Counter(
-    "build_watcher_builds_failed_total", "Number of builds failed.", [], registry=prometheus_registry
-)
 
 
 def _buildlog_metadata(api_endpoint: Optional[str] = None, build_log: str = None) -> Dict[str, str]:
@@ -84,17 +102,125 @@ def _buildlog_metadata(api_endpoint: Optional[str] = None, build_log: str = None
     return {"apiversion": api_endpoint, "kind": "BuildLog", "log": build_log}
 
 
-def _existing_producer(queue: Queue, build_watcher_namespace: str) -> None:
+@functools.lru_cache(maxsize=1)
+def _get_openshift() -> OpenShift:
+    """Get OpenShift client, the client is shared as its instantiation performs API discovery."""
+    return OpenShift()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_resource(api_version: str, kind: str) -> Any:
+    """Get resource of the given kind using the shared OpenShift client."""
+    return _get_openshift().ocp_client.resources.get(api_version=api_version, kind=kind)
+
+
+def _run_in_thread(target: Callable[..., None], *args: Any) -> Future:
+    """Run the given function in a daemon thread, the returned future is resolved once the function finishes."""
+    future: Future = Future()
+
+    def _run() -> None:
+        try:
+            future.set_result(target(*args))
+        except BaseException as exc:
+            _LOGGER.exception("Function %r failed: %s", target.__name__, str(exc))
+            future.set_exception(exc)
+
+    Thread(target=_run, daemon=True).start()
+    return future
+
+
+def _cache_api_discovery(thoth_api_host: str) -> None:
+    """Discover Thoth's User API once instead of on each request done by thamos."""
+    api_discovery = functools.lru_cache(maxsize=None)(configuration.api_discovery)
+    configuration.api_discovery = api_discovery
+
+    try:
+        _LOGGER.info("Using Thoth's User API at %r", api_discovery(thoth_api_host))
+    except Exception as exc:
+        # Discovery is retried on the next request as failures are not cached.
+        _LOGGER.warning("Failed to discover Thoth's User API at %r: %s", thoth_api_host, str(exc))
+
+
+def _handle_sigterm(signum: int, frame: Any) -> None:
+    """Shut down gracefully on SIGTERM, e.g. when the pod is deleted."""
+    raise SystemExit(0)
+
+
+def _queued_recently(queued_images: Dict[bytes, float], identifier: str) -> bool:
+    """Check if the given build or image digest was seen recently, mark it as seen now."""
+    key = hashlib.blake2b(identifier.encode(), digest_size=16).digest()
+    now = time.monotonic()
+    # Refresh the time also on hit so that builds and images reported over and over stay deduplicated.
+    seen = queued_images.get(key)
+    queued_images[key] = now
+    return seen is not None and now - seen < _QUEUED_IMAGES_TTL
+
+
+def _evict_queued_images(queued_images: Dict[bytes, float]) -> None:
+    """Remove builds and images which were queued for analysis before the deduplication time period."""
+    now = time.monotonic()
+    for key, queued in list(queued_images.items()):
+        if now - queued >= _QUEUED_IMAGES_TTL:
+            queued_images.pop(key, None)
+
+
+def _existing_producer(queue: Queue, queued_images: Dict[bytes, float], build_watcher_namespace: str) -> None:
     """Query for existing images in image streams and queue them for analysis."""
-    openshift = OpenShift()
-    v1_imagestreams = openshift.ocp_client.resources.get(api_version="image.openshift.io/v1", kind="ImageStream")
-    for item in v1_imagestreams.get(namespace=build_watcher_namespace).items:
-        _LOGGER.debug("Found imagestream item: %s", str(item))
-        _LOGGER.debug("Listing tags available for %r", item["metadata"]["name"])
-        for tag_info in item.status.tags or []:
-            output_reference = f"{item.status.dockerImageRepository}:{tag_info.tag}"
+    v1_imagestreams = _get_resource(api_version="image.openshift.io/v1", kind="ImageStream")
+    # Image streams are not wrapped into resource instances, only a few fields are used.
+    response = v1_imagestreams.get(namespace=build_watcher_namespace, serialize=False)
+    try:
+        items = json.loads(response.data)["items"]
+    finally:
+        response.release_conn()
+
+    batch = []
+    debug = _LOGGER.isEnabledFor(logging.DEBUG)
+    for index, item in enumerate(items):
+        if debug:
+            _LOGGER.debug("Found imagestream item: %s", str(item))
+            _LOGGER.debug("Listing tags available for %r", item["metadata"]["name"])
+
+        status = item.get("status") or {}
+        repository = status.get("dockerImageRepository")
+        if not repository:
+            _LOGGER.debug("No repository assigned to imagestream %r, skipping it", item["metadata"]["name"])
+            continue
+
+        tags = status.get("tags") or []
+        for tag_index, tag_info in enumerate(tags):
+            if SHUTDOWN.is_set():
+                # Tags of this and the following image streams were not checked yet.
+                remaining = len(tags) - tag_index
+                remaining += sum(len((i.get("status") or {}).get("tags") or []) for i in items[index + 1 :])
+                _LOGGER.warning(
+                    "Queueing existing images interrupted on shutdown, %d images in a batch and %d image stream "
+                    "tags not checked yet were not queued",
+                    len(batch),
+                    remaining,
+                )
+                return
+
+            output_reference = repository + ":" + tag_info["tag"]
+            # Tags are mutable, compare images by the digest the tag currently points to.
+            tag_items = tag_info.get("items") or []
+            image_digest = tag_items[0].get("image") if tag_items else None
+            if image_digest and _queued_recently(queued_images, image_digest):
+                _LOGGER.debug(
+                    "Image %r (%s) was already queued for analysis recently, skipping it",
+                    output_reference,
+                    image_digest,
+                )
+                continue
+
             _LOGGER.info("Queueing already existing image %r for analysis", output_reference)
-            queue.put(output_reference)
+            batch.append(output_reference)
+            if len(batch) >= _EXISTING_IMAGES_BATCH_SIZE:
+                queue.put(batch)
+                batch = []
+
+    if batch:
+        queue.put(batch)
 
     _LOGGER.info("Queuing existing images for analyses has finished, all of them were scheduled for analysis")
 
@@ -124,47 +250,125 @@ def _get_build(
     return build_reference
 
 
-def _event_producer(queue: Queue, build_watcher_namespace: str) -> None:
-    """Accept events from the cluster and queue them into work queue processed by the main process."""
+def _iter_watch_events(response: Any) -> Iterator[Dict[str, Any]]:
+    """Parse raw watch events, each event is a JSON document on a separate line."""
+    buffer = bytearray()
+    try:
+        for chunk in response.read_chunked(decode_content=False):
+            buffer += chunk
+            start = 0
+            while True:
+                end = buffer.find(b"\n", start)
+                if end == -1:
+                    break
+
+                if end > start:
+                    yield json.loads(buffer[start:end])
+
+                start = end + 1
+
+            del buffer[:start]
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def _list_builds(namespace: str) -> Tuple[List[Dict[str, Any]], str]:
+    """List completed builds, return them with the resource version of the listing to start a watch from."""
+    v1_build = _get_resource(api_version="build.openshift.io/v1", kind="Build")
+    response = v1_build.get(namespace=namespace, field_selector=_BUILD_WATCH_FIELD_SELECTOR, serialize=False)
+    try:
+        build_list = json.loads(response.data)
+    finally:
+        response.release_conn()
+
+    return build_list["items"], build_list["metadata"]["resourceVersion"]
+
+
+def _queue_build(queue: Queue, queued_images: Dict[bytes, float], build: Dict[str, Any]) -> None:
+    """Queue the given completed build for analysis unless it was queued recently."""
+    build_name = build["metadata"]["name"]
+    # The same build can be reported multiple times (e.g. when builds are listed again), each build is analyzed
+    # once. Output references are tags shared by all the builds of a build config, they cannot be used to detect
+    # duplicates.
+    if _queued_recently(queued_images, build["metadata"]["uid"]):
+        _LOGGER.debug("Build %r was already queued for analysis recently, skipping it", build_name)
+        return
+
+    # Record the resulting image so that it is not queued again when listing existing images.
+    image_digest = ((build["status"].get("output") or {}).get("to") or {}).get("imageDigest")
+    if image_digest:
+        _queued_recently(queued_images, image_digest)
+
+    build_reference = {
+        "build_log_reference": _buildlog_metadata(),
+        "base_input_reference": None,
+        "output_reference": build["status"].get("outputDockerImageReference"),
+    }
+    strategy = build["spec"]["strategy"]
+    build_reference = _get_build(_get_openshift(), strategy, build_reference, build["metadata"])
+    _LOGGER.info("Queueing build log based on build %r for further processing", build_name)
+    queue.put(build_reference)
+
+
+def _event_producer(queue: Queue, queued_images: Dict[bytes, float], build_watcher_namespace: str) -> None:
+    """Accept events from the cluster and queue them into work queue processed by workers."""
     _LOGGER.info("Starting event producer")
-    openshift = OpenShift()
-    v1_build = openshift.ocp_client.resources.get(api_version="build.openshift.io/v1", kind="Build")
-    for event in v1_build.watch(namespace=build_watcher_namespace):
-        event_name = event["object"].metadata.name
-        build_reference = {
-            "build_log_reference": _buildlog_metadata(),
-            "base_input_reference": None,
-            "output_reference": None,
-        }
-        if event["object"].status.phase != "Complete":
-            _LOGGER.debug(
-                "Ignoring build event for %r - not completed phase %r", event_name, event["object"].status.phase
-            )
-            continue
-        elif event["object"].status.phase == "Failed":
-            _LOGGER.debug(
-                "Submitting base_image and build_log as build event for %r - the phase is %r",
-                event_name,
-                event["object"].status.phase,
+    v1_build = _get_resource(api_version="build.openshift.io/v1", kind="Build")
+    last_eviction = time.monotonic()
+    resource_version = None
+    while True:
+        try:
+            if resource_version is None:
+                # Builds completed so far are listed and the watch starts from the listing. A watch started without
+                # a resource version would report all of them again, each event carrying its own (old) resource
+                # version to resume from.
+                builds, resource_version = _list_builds(build_watcher_namespace)
+                _LOGGER.info("Found %d completed builds, watching for new builds", len(builds))
+                for build in builds:
+                    if SHUTDOWN.is_set():
+                        return
+
+                    _queue_build(queue, queued_images, build)
+
+            # Let the cluster filter out builds which are not completed. The watch is periodically restarted
+            # (resuming from the last seen resource version) so that a stale connection does not block forever.
+            # Events are parsed directly from the response as only a few fields of builds are used.
+            response = v1_build.get(
+                namespace=build_watcher_namespace,
+                field_selector=_BUILD_WATCH_FIELD_SELECTOR,
+                resource_version=resource_version,
+                timeout_seconds=_BUILD_WATCH_TIMEOUT,
+                watch=True,
+                query_params=[("allowWatchBookmarks", "true")],
+                serialize=False,
             )
-            strategy = event["object"].spec.strategy
-            build_reference = _get_build(openshift, strategy, build_reference, event["object"].metadata)
-            _LOGGER.info("Queueing build log based on build event %r for further processing", event_name)
-            _METRIC_BUILDS_FAILED.inc()
-            try:
-                _LOGGER.info("Submitting metrics to Prometheus pushgateway %r", _THOTH_METRICS_PUSHGATEWAY_URL)
-                push_to_gateway(_THOTH_METRICS_PUSHGATEWAY_URL, job="build-watcher", registry=prometheus_registry)
-            except Exception as e:
-                _LOGGER.exception(f"An error occurred pushing the metrics: {str(e)}")
-            queue.put(build_reference)
-            continue
+            for event in _iter_watch_events(response):
+                if SHUTDOWN.is_set():
+                    return
+
+                build = event["object"]
+                if event["type"] == "ERROR":
+                    raise ApiException(status=build.get("code"), reason=build.get("message"))
+
+                resource_version = build["metadata"]["resourceVersion"]
+                # Deleted builds (e.g. pruned build history) were already analyzed.
+                if event["type"] in ("BOOKMARK", "DELETED"):
+                    continue
+
+                if time.monotonic() - last_eviction > 60:
+                    _evict_queued_images(queued_images)
+                    last_eviction = time.monotonic()
+
+                _LOGGER.debug("New build event: %s", event)
+                _queue_build(queue, queued_images, build)
+        except ApiException as exc:
+            if exc.status != 410:
+                raise
 
-        _LOGGER.debug("New build event: %s", str(event))
-        build_reference["output_reference"] = event["object"].status.outputDockerImageReference
-        strategy = event["object"].spec.strategy
-        build_reference = _get_build(openshift, strategy, build_reference, event["object"].metadata)
-        _LOGGER.info("Queueing build log based on build event %r for further processing", event_name)
-        queue.put(build_reference)
+            # The resource version is too old, list builds again and watch from the current state.
+            _LOGGER.warning("Build watch expired, listing builds again: %s", str(exc))
+            resource_version = None
 
 
 def _do_analyze_build(
@@ -182,141 +386,201 @@ def _do_analyze_build(
     dst_verify_tls: bool = True,
     debug: bool = False,
     force: bool = False,
-) -> None:
+    push_executor: ThreadPoolExecutor,
+    submission_executor: ThreadPoolExecutor,
+    previous_submission: Optional[Future] = None,
+) -> Future:
+    """Push images to the push registry and hand off their submission to Thoth, return the submission future."""
     if push_registry:
-        _LOGGER.info("Pushing output image %r to an external push registry %r", output_reference, push_registry)
-        output_reference = _push_image(
-            output_reference,
-            push_registry,
-            src_registry_user,
-            src_registry_password,
-            dst_registry_user,
-            dst_registry_password,
+        push = functools.partial(
+            push_image,
+            push_registry=push_registry,
+            src_registry_user=src_registry_user,
+            src_registry_password=src_registry_password,
+            dst_registry_user=dst_registry_user,
+            dst_registry_password=dst_registry_password,
             src_verify_tls=src_verify_tls,
             dst_verify_tls=dst_verify_tls,
         )
+        # Output and base image are independent, push them concurrently.
+        output_push, base_push = None, None
         if output_reference:
-            _METRIC_IMAGES_PUSHED_REGISTRY.inc()
-            _LOGGER.info("Successfully pushed output image to %r", output_reference)
+            _LOGGER.info("Pushing output image %r to an external push registry %r", output_reference, push_registry)
+            output_push = push_executor.submit(push, output_reference)
 
         if base_input_reference:
             _LOGGER.info("Pushing base image %r to an external push registry %r", base_input_reference, push_registry)
-            base_input_reference = _push_image(
-                base_input_reference,
-                push_registry,
-                src_registry_user,
-                src_registry_password,
-                dst_registry_user,
-                dst_registry_password,
-                src_verify_tls=src_verify_tls,
-                dst_verify_tls=dst_verify_tls,
-            )
+            base_push = push_executor.submit(push, base_input_reference)
+
+        if output_push:
+            output_reference = output_push.result()
+            if output_reference:
+                _METRIC_IMAGES_PUSHED_REGISTRY.inc()
+                _LOGGER.info("Successfully pushed output image to %r", output_reference)
+
+        if base_push:
+            base_input_reference = base_push.result()
             if base_input_reference:
                 _METRIC_IMAGES_PUSHED_REGISTRY.inc()
                 _LOGGER.info("Successfully pushed base image to %r", base_input_reference)
 
-    analysis_response = build_analysis(
-        build_log=build_log_reference,
-        base_image=base_input_reference,
-        base_registry_password=src_registry_password,
-        base_registry_user=src_registry_user,
-        base_registry_verify_tls=src_verify_tls,
-        environment_type=environment_type,
-        nowait=True,
-        output_image=output_reference,
-        output_registry_password=dst_registry_password,
-        output_registry_user=dst_registry_user,
-        output_registry_verify_tls=dst_verify_tls,
-        force=force,
-        debug=debug,
-    )
-
-    if analysis_response.base_image_analysis and analysis_response.base_image_analysis.analysis_id:
-        _METRIC_IMAGES_SUBMITTED.inc()
-    if analysis_response.buildlog_analysis and analysis_response.buildlog_analysis.analysis_id:
-        _METRIC_BUILD_LOGS_SUBMITTED.inc()
-    if analysis_response.output_image_analysis and analysis_response.output_image_analysis.analysis_id:
-        _METRIC_IMAGES_SUBMITTED.inc()
+    # Submissions are done in the background so that the worker can push the next images meanwhile. Wait for the
+    # previous submission of this worker so that there is at most one submission in flight per worker.
+    if previous_submission:
+        wait([previous_submission])
 
-    if _THOTH_METRICS_PUSHGATEWAY_URL:
-        try:
-            _LOGGER.info("Submitting metrics to Prometheus pushgateway %r", _THOTH_METRICS_PUSHGATEWAY_URL)
-            push_to_gateway(_THOTH_METRICS_PUSHGATEWAY_URL, job="build-watcher", registry=prometheus_registry)
-        except Exception as e:
-            _LOGGER.exception(f"An error occurred pushing the metrics: {str(e)}")
-    else:
-        _LOGGER.info("Not pushing metrics as Prometheus pushgateway was not provided")
-
-    _LOGGER.info(
-        "Successfully submitted %r, %r, build log, build log analysis to Thoth for analysis; "
-        "analysis ids respectively: %r, %r, %r, %r",
+    return submission_executor.submit(
+        _submit_build_analysis,
         output_reference,
+        build_log_reference,
         base_input_reference,
-        analysis_response.output_image_analysis.analysis_id if analysis_response.output_image_analysis else None,
-        analysis_response.base_image_analysis.analysis_id if analysis_response.base_image_analysis else None,
-        analysis_response.buildlog_document_id,
-        analysis_response.buildlog_analysis.analysis_id if analysis_response.buildlog_analysis else None,
+        environment_type=environment_type,
+        src_registry_user=src_registry_user,
+        src_registry_password=src_registry_password,
+        dst_registry_user=dst_registry_user,
+        dst_registry_password=dst_registry_password,
+        src_verify_tls=src_verify_tls,
+        dst_verify_tls=dst_verify_tls,
+        debug=debug,
+        force=force,
     )
 
 
-def _push_image(
-    image: str,
-    push_registry: str,
+def _submit_build_analysis(
+    output_reference: Optional[str] = None,
+    build_log_reference: Optional[str] = None,
+    base_input_reference: Optional[str] = None,
+    *,
+    environment_type: Optional[str] = None,
     src_registry_user: Optional[str] = None,
     src_registry_password: Optional[str] = None,
     dst_registry_user: Optional[str] = None,
     dst_registry_password: Optional[str] = None,
     src_verify_tls: bool = True,
     dst_verify_tls: bool = True,
-) -> Optional[str]:
-    """Push the given image (fully specified with registry info) into another registry."""
-    cmd = f"{_SKOPEO_EXEC_PATH} --insecure-policy copy "
-
-    if not src_verify_tls:
-        cmd += "--src-tls-verify=false "
-
-    if not dst_verify_tls:
-        cmd += "--dest-tls-verify=false "
-
-    if dst_registry_user or dst_registry_password:
-        dst_registry_user = dst_registry_user or "build-watcher"
-        cmd += f"--dest-creds={dst_registry_user}"
-
-        if dst_registry_password:
-            cmd += f":{dst_registry_password}"
+    debug: bool = False,
+    force: bool = False,
+) -> None:
+    """Submit the given (already pushed) references to Thoth for analysis."""
+    try:
+        analysis_response = build_analysis(
+            build_log=build_log_reference,
+            base_image=base_input_reference,
+            base_registry_password=src_registry_password,
+            base_registry_user=src_registry_user,
+            base_registry_verify_tls=src_verify_tls,
+            environment_type=environment_type,
+            nowait=True,
+            output_image=output_reference,
+            output_registry_password=dst_registry_password,
+            output_registry_user=dst_registry_user,
+            output_registry_verify_tls=dst_verify_tls,
+            force=force,
+            debug=debug,
+        )
 
-        cmd += " "
+        if analysis_response.base_image_analysis and analysis_response.base_image_analysis.analysis_id:
+            _METRIC_IMAGES_SUBMITTED.inc()
+        if analysis_response.buildlog_analysis and analysis_response.buildlog_analysis.analysis_id:
+            _METRIC_BUILD_LOGS_SUBMITTED.inc()
+        if analysis_response.output_image_analysis and analysis_response.output_image_analysis.analysis_id:
+            _METRIC_IMAGES_SUBMITTED.inc()
 
-    if src_registry_user or src_registry_password:
-        src_registry_user = src_registry_user or "build-watcher"
-        cmd += f"--src-creds={src_registry_user}"
+        if _THOTH_METRICS_PUSHGATEWAY_URL:
+            try:
+                _LOGGER.info("Submitting metrics to Prometheus pushgateway %r", _THOTH_METRICS_PUSHGATEWAY_URL)
+                push_to_gateway(_THOTH_METRICS_PUSHGATEWAY_URL, job="build-watcher", registry=prometheus_registry)
+            except Exception as e:
+                _LOGGER.exception(f"An error occurred pushing the metrics: {str(e)}")
+        else:
+            _LOGGER.info("Not pushing metrics as Prometheus pushgateway was not provided")
 
-        if dst_registry_password:
-            cmd += f":{src_registry_password}"
+        _LOGGER.info(
+            "Successfully submitted %r, %r, build log, build log analysis to Thoth for analysis; "
+            "analysis ids respectively: %r, %r, %r, %r",
+            output_reference,
+            base_input_reference,
+            analysis_response.output_image_analysis.analysis_id if analysis_response.output_image_analysis else None,
+            analysis_response.base_image_analysis.analysis_id if analysis_response.base_image_analysis else None,
+            analysis_response.buildlog_document_id,
+            analysis_response.buildlog_analysis.analysis_id if analysis_response.buildlog_analysis else None,
+        )
+    except Exception as exc:
+        _LOGGER.exception("Failed to submit image %r for analysis to Thoth: %s", output_reference, str(exc))
 
-        cmd += " "
 
-    image_name = image.rsplit("/", maxsplit=1)[1]
-    if "quay.io" in push_registry:
-        image_name = image_name.replace("@sha256", "")
-        output = f"{push_registry}:{image_name.replace(':','-')}"
+def _submit_reference(
+    reference: Any,
+    push_registry: str,
+    environment_type: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    no_src_registry_tls_verify: bool = False,
+    no_dst_registry_tls_verify: bool = False,
+    no_base: bool = False,
+    no_output: bool = False,
+    no_build_log: bool = False,
+    debug: bool = False,
+    force: bool = False,
+    *,
+    push_executor: ThreadPoolExecutor,
+    submission_executor: ThreadPoolExecutor,
+    previous_submission: Optional[Future] = None,
+) -> Optional[Future]:
+    """Submit the given reference (an image or a build reference) to Thoth for analysis."""
+    if isinstance(reference, dict):
+        build_log_reference = reference.get("build_log_reference", _buildlog_metadata())
+        base_input_reference = reference.get("base_input_reference", None)
+        output_reference = reference.get("output_reference", None)
     else:
-        output = f"{push_registry}/{image_name}"
-    _LOGGER.debug("Pushing image %r from %r to registry %r, output is %r", image_name, image, push_registry, output)
-    cmd += f"docker://{image} docker://{output}"
+        output_reference = reference
+        build_log_reference = _buildlog_metadata()
+        base_input_reference = None
+        _LOGGER.info("Handling analysis of image %r", reference)
+
+    if ABANDON.is_set():
+        _LOGGER.warning("Abandoning image %r on shutdown, it will not be analyzed", output_reference)
+        return None
+
+    output = output_reference if not no_output else None
+    build_log = build_log_reference if not no_build_log else None
+    base = base_input_reference if not no_base else None
+
+    if not output and not build_log and not base:
+        _LOGGER.warning(
+            "Skipping %r as no input for build analysis would be sent based on limitations on "
+            "data to be sent; no base: %r, no output: %r, no build log: %r",
+            output_reference,
+            no_base,
+            no_output,
+            no_build_log,
+        )
+        return None
 
-    _LOGGER.debug("Running: %s", cmd)
     try:
-        command = run_command(cmd)
-        _LOGGER.debug("%s stdout:\n%s\n%s", _SKOPEO_EXEC_PATH, command.stdout, command.stderr)
-    except CommandError as exc:
-        if "Error determining manifest MIME type" in exc.stderr:
-            # Manifest MIME type error is caused by the way image is build. we have no control over it.
-            _LOGGER.warning("Ignoring error caused by invalid manifest MIME type during push: %s", str(exc))
-            return None
-        else:
-            _LOGGER.exception("Failed to push image %r to external registry: %s", image_name, str(exc))
-    return output
+        return _do_analyze_build(
+            output,
+            build_log,
+            base,
+            push_registry,
+            environment_type=environment_type,
+            src_registry_user=src_registry_user if base else None,
+            src_registry_password=src_registry_password if base else None,
+            dst_registry_user=dst_registry_user if output else None,
+            dst_registry_password=dst_registry_password if output else None,
+            src_verify_tls=not no_src_registry_tls_verify,
+            dst_verify_tls=not no_dst_registry_tls_verify,
+            debug=debug,
+            force=force,
+            push_executor=push_executor,
+            submission_executor=submission_executor,
+            previous_submission=previous_submission,
+        )
+    except Exception as exc:
+        _LOGGER.exception("Failed to submit image %r for analysis to Thoth: %s", output_reference, str(exc))
+        return None
 
 
 def _submitter(
@@ -334,53 +598,41 @@ def _submitter(
     no_build_log: bool = False,
     debug: bool = False,
     force: bool = False,
+    *,
+    push_executor: ThreadPoolExecutor,
+    submission_executor: ThreadPoolExecutor,
 ) -> None:
     """Read messages from queue and submit each message with image to Thoth for analysis."""
+    submit = functools.partial(
+        _submit_reference,
+        push_registry=push_registry,
+        environment_type=environment_type,
+        src_registry_user=src_registry_user,
+        src_registry_password=src_registry_password,
+        dst_registry_user=dst_registry_user,
+        dst_registry_password=dst_registry_password,
+        no_src_registry_tls_verify=no_src_registry_tls_verify,
+        no_dst_registry_tls_verify=no_dst_registry_tls_verify,
+        no_base=no_base,
+        no_output=no_output,
+        no_build_log=no_build_log,
+        debug=debug,
+        force=force,
+        push_executor=push_executor,
+        submission_executor=submission_executor,
+    )
+    # Submission of the previously processed reference which can still be in progress.
+    pending: Optional[Future] = None
     while True:
-        reference = queue.get()
-        if isinstance(reference, dict):
-            build_log_reference = reference.get("build_log_reference", _buildlog_metadata())
-            base_input_reference = reference.get("base_input_reference", None)
-            output_reference = reference.get("output_reference", None)
-        else:
-            output_reference = reference
-            build_log_reference = _buildlog_metadata()
-            base_input_reference = None
-            _LOGGER.info("Handling analysis of image %r", reference)
-
-        output = output_reference if not no_output else None
-        build_log = build_log_reference if not no_build_log else None
-        base = base_input_reference if not no_base else None
-
-        if not output and not build_log and not base:
-            _LOGGER.warning(
-                "Skipping %r as no input for build analysis would be sent based on limitations on "
-                "data to be sent; no base: %r, no output: %r, no build log: %r",
-                output_reference,
-                no_base,
-                no_output,
-                no_build_log,
-            )
-            continue
+        item = queue.get()
+        if item is None:
+            # Sent on shutdown, no more work for this worker.
+            return
 
-        try:
-            _do_analyze_build(
-                output,
-                build_log,
-                base,
-                push_registry,
-                environment_type=environment_type,
-                src_registry_user=src_registry_user if base else None,
-                src_registry_password=src_registry_password if base else None,
-                dst_registry_user=dst_registry_user if output else None,
-                dst_registry_password=dst_registry_password if output else None,
-                src_verify_tls=not no_src_registry_tls_verify,
-                dst_verify_tls=not no_dst_registry_tls_verify,
-                debug=debug,
-                force=force,
-            )
-        except Exception as exc:
-            _LOGGER.exception("Failed to submit image %r for analysis to Thoth: %s", output_reference, str(exc))
+        # Thoth does not provide an endpoint to submit multiple analyses at once, references queued in a batch
+        # are submitted one by one by this worker so that the number of workers bounds the concurrency.
+        for reference in item if isinstance(item, list) else [item]:
+            pending = submit(reference, previous_submission=pending) or pending
 
 
 @click.command()
@@ -489,7 +741,14 @@ def _submitter(
     default=1,
     show_default=True,
     envvar="THOTH_BUILD_WATCHER_WORKERS",
-    help="Number of worker processes to submit image analysis in parallel.",
+    help="Number of worker threads to submit image analysis in parallel.",
+)
+@click.option(
+    "--queue-maxsize",
+    type=int,
+    envvar="THOTH_QUEUE_MAXSIZE",
+    help="Maximum number of images waiting in the work queue, producers block once the queue is full "
+    "[default: max(32, 4 * workers count)].",
 )
 @click.option(
     "--environment-type",
@@ -550,6 +809,7 @@ def cli(
     push_registry: Optional[str] = None,
     analyze_existing: bool = False,
     workers_count: int = 1,
+    queue_maxsize: Optional[int] = None,
     environment_type: Optional[str] = None,
     no_base: bool = False,
     no_output: bool = False,
@@ -576,18 +836,21 @@ def cli(
         thoth_api_host,
     )
 
-    # All the images to be processed are submitted onto this queue by producers.
-    manager = Manager()
-    queue = manager.Queue()
+    # All the images to be processed are submitted onto this queue by producers. The queue is bounded so that
+    # producers block (instead of consuming memory) if workers cannot keep up.
+    queue = WorkQueue(maxsize=queue_maxsize or max(32, workers_count * 4))
+    # Images recently queued by any of the producers, used to avoid submitting the same image multiple times.
+    queued_images = {}
+    # Instantiate the client before producers are started so that they reuse it.
+    openshift = _get_openshift()
 
     if analyze_existing:
-        # We do this in a standalone process, but reuse worker queue to process images.
-        existing_producer = Process(target=_existing_producer, args=(queue, build_watcher_namespace))
-        existing_producer.start()
+        # We do this in a standalone thread, but reuse worker queue to process images.
+        _run_in_thread(_existing_producer, queue, queued_images, build_watcher_namespace)
 
     configuration.explicit_host = thoth_api_host
     configuration.tls_verify = not no_tls_verify
-    openshift = OpenShift()
+    _cache_api_discovery(thoth_api_host)
 
     if not push_registry and (src_registry_password or src_registry_user):
         raise ValueError("Source credentials can be used only if push registry is configured")
@@ -606,8 +869,8 @@ def cli(
             dst_registry_user = "build-watcher"
             dst_registry_password = openshift.token
 
-    producer = Process(target=_event_producer, args=(queue, build_watcher_namespace))
-    producer.start()
+    # Producers are daemon threads as they block on the cluster API and cannot be asked to stop.
+    producer = _run_in_thread(_event_producer, queue, queued_images, build_watcher_namespace)
 
     args = [
         queue,
@@ -625,29 +888,42 @@ def cli(
         debug,
         force,
     ]
-    # We do not use multiprocessing's Pool here as we manage lifecycle of workers on our own. If any fails, give
-    # up and report errors.
-    process_pool = []
+    # Workers are I/O bound (pushing images, talking to Thoth), threads share the imported modules and clients.
+    # If any of the workers or the event producer stops, give up and report errors.
     _LOGGER.info(
-        "Starting worker processes, number of workers is set to: %d, environment type of images submitted is %s",
+        "Starting worker threads, number of workers is set to: %d, environment type of images submitted is %s",
         workers_count,
         environment_type,
     )
-    for worker in range(workers_count):
-        p = Process(target=_submitter, args=args)
-        p.start()
-        _LOGGER.info("Started a new worker with PID: %d", p.pid)
-        process_pool.append(p)
-
-    # Check if all the processes is still alive.
-    while True:
-        if any(not process.is_alive() for process in process_pool):
-            raise RuntimeError("One of the processes failed")
-
-        time.sleep(5)
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    # Executors are shut down in the reverse order - workers stop first, then pushes and submissions they started.
+    with ThreadPoolExecutor(
+        max_workers=workers_count, thread_name_prefix="submission"
+    ) as submission_executor, ThreadPoolExecutor(
+        max_workers=2 * workers_count, thread_name_prefix="push"
+    ) as push_executor, ThreadPoolExecutor(
+        max_workers=workers_count, thread_name_prefix="worker"
+    ) as executor:
+        workers = [
+            executor.submit(_submitter, *args, push_executor=push_executor, submission_executor=submission_executor)
+            for _ in range(workers_count)
+        ]
+        try:
+            # Block until one of them finishes, there is no need to poll as they are expected to run forever.
+            done, _ = wait(workers + [producer], return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name = "Event producer" if future is producer else "Worker"
+                if future.exception():
+                    _LOGGER.error("%s failed: %s", name, str(future.exception()))
+                else:
+                    _LOGGER.error("%s unexpectedly stopped", name)
+        finally:
+            # Do not interrupt pushes in progress, the executors wait for the remaining work to finish.
+            stop_workers(queue, workers)
 
     # Always fail, this should be run forever.
-    sys.exit(1)
+    raise RuntimeError("One of the workers or the event producer failed")
 
 
 if __name__ == "__main__":
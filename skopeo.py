@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# thoth-build-watcher
+# Copyright(C) 2021 Fridolin Pokorny
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Pushing images to an external registry using skopeo."""
+
+import functools
+import logging
+import os
+import subprocess
+from typing import Optional
+from typing import Tuple
+from collections import OrderedDict
+from threading import Lock
+
+_LOGGER = logging.getLogger("thoth.build_watcher")
+
+_HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+_SKOPEO_EXEC_PATH = os.getenv("SKOPEO_EXEC_PATH", os.path.join(_HERE_DIR, "bin", "skopeo"))
+_SKOPEO_TIMEOUT = 60
+# Images referenced by digest are immutable, keep track of the ones already pushed to avoid running skopeo again.
+_PUSHED_IMAGES_CACHE_SIZE = 1024
+_PUSHED_IMAGES: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_PUSHED_IMAGES_LOCK = Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _skopeo_copy_argv(
+    src_registry_user: Optional[str],
+    src_registry_password: Optional[str],
+    dst_registry_user: Optional[str],
+    dst_registry_password: Optional[str],
+    src_verify_tls: bool,
+    dst_verify_tls: bool,
+) -> Tuple[str, ...]:
+    """Construct skopeo copy arguments except for source and destination, they are constant for a configuration."""
+    argv = [_SKOPEO_EXEC_PATH, "--insecure-policy", "copy"]
+
+    if not src_verify_tls:
+        argv.append("--src-tls-verify=false")
+
+    if not dst_verify_tls:
+        argv.append("--dest-tls-verify=false")
+
+    if dst_registry_user or dst_registry_password:
+        dst_registry_user = dst_registry_user or "build-watcher"
+        if dst_registry_password:
+            argv.append(f"--dest-creds={dst_registry_user}:{dst_registry_password}")
+        else:
+            argv.append(f"--dest-creds={dst_registry_user}")
+
+    if src_registry_user or src_registry_password:
+        src_registry_user = src_registry_user or "build-watcher"
+        if src_registry_password:
+            argv.append(f"--src-creds={src_registry_user}:{src_registry_password}")
+        else:
+            argv.append(f"--src-creds={src_registry_user}")
+
+    return tuple(argv)
+
+
+def push_image(
+    image: str,
+    push_registry: str,
+    src_registry_user: Optional[str] = None,
+    src_registry_password: Optional[str] = None,
+    dst_registry_user: Optional[str] = None,
+    dst_registry_password: Optional[str] = None,
+    src_verify_tls: bool = True,
+    dst_verify_tls: bool = True,
+) -> Optional[str]:
+    """Push the given image (fully specified with registry info) into another registry."""
+    cache_key = (image, push_registry)
+    with _PUSHED_IMAGES_LOCK:
+        cached_output = _PUSHED_IMAGES.get(cache_key)
+        if cached_output:
+            _PUSHED_IMAGES.move_to_end(cache_key)
+
+    if cached_output:
+        _LOGGER.debug("Image %r was already pushed to %r, not pushing it again", image, cached_output)
+        return cached_output
+
+    image_name = image.rsplit("/", maxsplit=1)[1]
+    if "quay.io" in push_registry:
+        image_name = image_name.replace("@sha256", "")
+        output = f"{push_registry}:{image_name.replace(':','-')}"
+    else:
+        output = f"{push_registry}/{image_name}"
+    _LOGGER.debug("Pushing image %r from %r to registry %r, output is %r", image_name, image, push_registry, output)
+    argv = [
+        *_skopeo_copy_argv(
+            src_registry_user,
+            src_registry_password,
+            dst_registry_user,
+            dst_registry_password,
+            src_verify_tls,
+            dst_verify_tls,
+        ),
+        f"docker://{image}",
+        f"docker://{output}",
+    ]
+
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        cmd = " ".join(argv)
+        for password in (src_registry_password, dst_registry_password):
+            if password:
+                cmd = cmd.replace(password, "***")
+        _LOGGER.debug("Running: %s", cmd)
+
+    try:
+        # No shell is involved, arguments are passed to skopeo as they are. File descriptors opened by Python are not
+        # inheritable, keeping them open (close_fds=False) lets subprocess use posix_spawn(3) instead of fork(2)
+        # which would copy page tables of the whole build-watcher process for each push.
+        command = subprocess.run(
+            argv,
+            check=True,
+            capture_output=True,
+            shell=False,
+            text=True,
+            timeout=_SKOPEO_TIMEOUT,
+            close_fds=False,
+        )
+        _LOGGER.debug("%s stdout:\n%s\n%s", _SKOPEO_EXEC_PATH, command.stdout, command.stderr)
+        if "@sha256:" in image:
+            with _PUSHED_IMAGES_LOCK:
+                _PUSHED_IMAGES[cache_key] = output
+                if len(_PUSHED_IMAGES) > _PUSHED_IMAGES_CACHE_SIZE:
+                    _PUSHED_IMAGES.popitem(last=False)
+    except subprocess.CalledProcessError as exc:
+        if "Error determining manifest MIME type" in exc.stderr:
+            # Manifest MIME type error is caused by the way image is build. we have no control over it.
+            _LOGGER.warning("Ignoring error caused by invalid manifest MIME type during push: %s", exc.stderr)
+            return None
+        else:
+            _LOGGER.error(
+                "Failed to push image %r to external registry (exit code %d): %s",
+                image_name,
+                exc.returncode,
+                exc.stderr,
+            )
+    except subprocess.TimeoutExpired:
+        _LOGGER.error("Failed to push image %r to external registry: timeout after %ds", image_name, _SKOPEO_TIMEOUT)
+    return output
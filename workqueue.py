@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# thoth-build-watcher
+# Copyright(C) 2021 Fridolin Pokorny
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Work queue shared by producers and workers and its shutdown handling."""
+
+import logging
+import time
+from typing import Any
+from typing import List
+from concurrent.futures import Future
+from concurrent.futures import wait
+from queue import Empty
+from queue import Full
+from queue import Queue
+from threading import Event
+
+_LOGGER = logging.getLogger("thoth.build_watcher")
+
+# Set on shutdown, producers stop queueing and workers process images which are already queued.
+SHUTDOWN = Event()
+# Time (in seconds) workers are given on shutdown to process queued images, the rest is abandoned.
+SHUTDOWN_TIMEOUT = 60
+# Set once the shutdown timeout is reached, workers abandon images they did not start processing.
+ABANDON = Event()
+
+
+class WorkQueue(Queue):
+    """Work queue bounded by the number of references waiting, a batch counts as all the references it holds."""
+
+    def _init(self, maxsize: int) -> None:
+        super()._init(maxsize)
+        self._references = 0
+
+    @staticmethod
+    def _references_count(item: Any) -> int:
+        return max(len(item), 1) if isinstance(item, list) else 1
+
+    def _qsize(self) -> int:
+        return self._references
+
+    def _put(self, item: Any) -> None:
+        super()._put(item)
+        self._references += self._references_count(item)
+
+    def _get(self) -> Any:
+        item = super()._get()
+        self._references -= self._references_count(item)
+        return item
+
+
+def _abandon_queued(queue: Queue) -> None:
+    """Remove all the items waiting in the queue, logging images which will not be analyzed."""
+    abandoned = 0
+    while True:
+        try:
+            item = queue.get_nowait()
+        except Empty:
+            break
+
+        for reference in item if isinstance(item, list) else [item]:
+            if reference is None:
+                continue
+
+            if isinstance(reference, dict):
+                reference = reference.get("output_reference")
+
+            _LOGGER.warning("Abandoning queued image %r, it will not be analyzed", reference)
+            abandoned += 1
+
+    if abandoned:
+        _LOGGER.warning("Abandoned %d queued images which were not processed", abandoned)
+
+
+def stop_workers(queue: Queue, workers: List[Future]) -> None:
+    """Stop workers once they process queued images, images not processed within the shutdown timeout are abandoned."""
+    _LOGGER.info("Stopping workers, waiting up to %d seconds for queued images to be processed", SHUTDOWN_TIMEOUT)
+    SHUTDOWN.set()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+
+    # Markers are queued after the images already waiting, workers stop once they process all of them.
+    try:
+        for _ in workers:
+            queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+    except Full:
+        pass
+
+    _, not_done = wait(workers, timeout=max(deadline - time.monotonic(), 0))
+    if not_done:
+        _LOGGER.warning("Workers did not process queued images in %d seconds, abandoning them", SHUTDOWN_TIMEOUT)
+        ABANDON.set()
+
+    # Items queued by producers blocked on a full queue before the shutdown are left behind the markers.
+    _abandon_queued(queue)
+
+    # Wake up workers still waiting for work, markers queued earlier could be removed from the queue.
+    for _ in not_done:
+        queue.put(None)